@@ -1,8 +1,9 @@
 import os
+import functools
 from dataclasses import dataclass
 from typing import Optional
 
-@dataclass
+@dataclass(frozen=True)
 class Config:
     # Server configuration
     HOST: str = os.getenv('HOST', '0.0.0.0')
@@ -12,17 +13,34 @@ class Config:
     # Model configuration
     HUGGINGFACE_TOKEN: Optional[str] = os.getenv('HUGGINGFACE_TOKEN')
     MODEL_NAME: str = os.getenv('MODEL_NAME', 'your-username/your-model-name')
+    EMBEDDING_BATCH_SIZE: int = int(os.getenv('EMBEDDING_BATCH_SIZE', 32))
+    TORCH_COMPILE: bool = os.getenv('TORCH_COMPILE', 'False').lower() == 'true'
     
     # Database configuration
     CSV_PATH: str = os.getenv('CSV_PATH', 'data/df_obat.csv')
+    EMBEDDING_CACHE_DIR: str = os.getenv('EMBEDDING_CACHE_DIR', 'data')  # one emb_<hash>/ subdirectory per model/CSV pair
+    CSV_CHUNK_SIZE: int = int(os.getenv('CSV_CHUNK_SIZE', 0))  # 0 reads the whole file with pyarrow
+    
+    # Retrieval configuration: exact (NumPy/Torch scan), flat, hnsw or sq8 (int8); the last three require faiss-cpu
+    INDEX_TYPE: str = os.getenv('INDEX_TYPE', 'exact').lower()
+    HNSW_M: int = int(os.getenv('HNSW_M', 32))
+    HNSW_EF_SEARCH: int = int(os.getenv('HNSW_EF_SEARCH', 64))
     
     # API configuration
     MAX_TOP_K: int = int(os.getenv('MAX_TOP_K', 20))
     DEFAULT_TOP_K: int = int(os.getenv('DEFAULT_TOP_K', 5))
+    PREDICTION_CACHE_SIZE: int = int(os.getenv('PREDICTION_CACHE_SIZE', 1024))
+    QUERY_BATCH_SIZE: int = int(os.getenv('QUERY_BATCH_SIZE', 32))
+    QUERY_BATCH_WAIT_MS: float = float(os.getenv('QUERY_BATCH_WAIT_MS', 5))
     
     # Initialization configuration
     AUTO_INITIALIZE: bool = os.getenv('AUTO_INITIALIZE', 'True').lower() == 'true'
     STARTUP_TIMEOUT: int = int(os.getenv('STARTUP_TIMEOUT', 600))  # 10 minutes
     
     # Logging
-    LOG_LEVEL: str = os.getenv('LOG_LEVEL', 'INFO')
\ No newline at end of file
+    LOG_LEVEL: str = os.getenv('LOG_LEVEL', 'INFO')
+
+@functools.lru_cache(maxsize=1)
+def get_config() -> Config:
+    """Return the process-wide configuration instance"""
+    return Config()
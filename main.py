@@ -8,7 +8,7 @@ load_dotenv()
 # Add project root to path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from config import Config
+from config import get_config
 from models.drug_predictor import DrugPredictor
 from services.api_service import APIService
 import logging
@@ -17,7 +17,7 @@ import logging
 def create_app():
     """Application factory for Gunicorn"""
     # Initialize configuration
-    config = Config()
+    config = get_config()
     
     # Setup logging
     logging.basicConfig(
@@ -46,10 +46,8 @@ def create_app():
 def main():
     """Main application entry point for direct execution"""
     try:
-        app = create_app()
-        
         # Get config for direct run
-        config = Config()
+        config = get_config()
         logger = logging.getLogger(__name__)
         
         logger.info("Starting application...")
@@ -60,6 +58,8 @@ def main():
         else:
             logger.info("🔧 Manual initialization - call POST /initialize to load model")
         
+        # `app` is the module-level instance created below for Gunicorn;
+        # reusing it avoids building the app (and loading the model) twice
         app.run(
             host=config.HOST,
             port=config.PORT,
@@ -0,0 +1,91 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+logger = logging.getLogger(__name__)
+
+class BatchScheduler:
+    """Coalesce concurrent single-item calls into batched calls on one worker thread"""
+
+    def __init__(self, process_batch: Callable[[List[Any]], List[Any]], max_batch_size: int = 32, max_wait: float = 0.005):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._in_flight = 0  # submitted items not yet handed back to their caller
+        self._lock = threading.Lock()
+
+    def submit(self, item: Any) -> Any:
+        """Queue an item and block until its batch has been processed"""
+        self._ensure_running()
+        future = Future()
+        with self._lock:
+            self._in_flight += 1
+        self._queue.put((item, future))
+        return future.result()
+
+    def _ensure_running(self):
+        """Start the worker thread lazily, once per process"""
+        # Threads do not survive fork, so a scheduler created before a
+        # gunicorn fork gets a fresh queue and thread in each worker
+        if self._thread is not None and self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+
+            self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._in_flight = 0
+            self._thread = threading.Thread(target=self._run, args=(self._queue,))
+            self._thread.daemon = True
+            self._thread.start()
+            logger.info(f"Batch scheduler started (max_batch_size={self.max_batch_size}, max_wait={self.max_wait * 1000:.1f}ms)")
+
+    def _run(self, pending: queue.Queue):
+        """Worker loop: batch whatever is queued, waiting only for callers already in flight"""
+        while True:
+            batch = [pending.get()]
+
+            # Take everything already queued without waiting, so a lone request is not delayed
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Other callers have submitted but not queued yet: wait for them, at most max_wait
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size and self._in_flight > len(batch):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                results = self.process_batch([item for item, _ in batch])
+            except Exception as e:
+                logger.error(f"Batch processing failed: {str(e)}")
+                self._finish(len(batch))
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self._finish(len(batch))
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def _finish(self, count: int):
+        """Mark a processed batch as no longer in flight"""
+        with self._lock:
+            self._in_flight -= count
@@ -1,22 +1,50 @@
 import pandas as pd
 import numpy as np
+import torch
+from scipy.linalg.blas import sgemv
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 from huggingface_hub import login
+from cachetools import LRUCache
+from models.batch_scheduler import BatchScheduler
 import logging
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union
 import threading
+import hashlib
+import glob
+import json
+import subprocess
+import sys
 import time
 import os
 
 logger = logging.getLogger(__name__)
 
+# Directory containing the `models` package, used as cwd for the GPU encoder subprocess
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Drug texts encoded per chunk while building embeddings, bounding peak memory
+EMBEDDING_CHUNK_ROWS = 10_000
+
+# Sequence lengths inputs are padded up to when the model is compiled, so compiled graphs are reused
+TOKEN_LENGTH_BUCKETS = (32, 64, 128, 256, 512)
+
 class DrugPredictor:
+    # Similarity thresholds and the confidence label for each bucket between them
+    _CONF_THRESH = np.array([0.4, 0.6, 0.8])
+    _CONF_LABELS = np.array(["very_low", "low", "medium", "high"])
+    
     def __init__(self, config):
         self.config = config
         self.model = None
+        self.device = None
+        self._device_pid = None
+        self._device_lock = threading.Lock()
         self.drug_embeddings = None
+        self._device_embeddings = None
+        self.index = None
         self.df_drugs = None
+        self._names = None
+        self._descs = None
         self.initialization_status = {
             "status": "not_started",
             "error": None,
@@ -27,6 +55,20 @@ class DrugPredictor:
         }
         self._lock = threading.Lock()
         self._initialization_thread = None
+        self._prediction_cache = LRUCache(maxsize=config.PREDICTION_CACHE_SIZE)
+        self._prediction_cache_lock = threading.Lock()
+        self._lowercase_cache_key = False
+        # Score buffers shared by all request threads (Werkzeug starts a thread per request)
+        self._similarity_buffers = []
+        # Batching only helps when a process serves concurrent requests (threaded server or
+        # gthread workers); QUERY_BATCH_SIZE=1 encodes directly on the request thread
+        self._query_batcher = None
+        if config.QUERY_BATCH_SIZE > 1:
+            self._query_batcher = BatchScheduler(
+                self._encode_queries,
+                max_batch_size=config.QUERY_BATCH_SIZE,
+                max_wait=config.QUERY_BATCH_WAIT_MS / 1000
+            )
     
     def initialize(self, background=False) -> bool:
         """Initialize the model and load drug database"""
@@ -57,6 +99,10 @@ class DrugPredictor:
             self.initialization_status["start_time"] = time.time()
             self.initialization_status["error"] = None
             
+            # Cached predictions belong to the previous model/database
+            with self._prediction_cache_lock:
+                self._prediction_cache.clear()
+            
             try:
                 # Step 1: Login to Hugging Face if token provided
                 if self.config.HUGGINGFACE_TOKEN:
@@ -70,13 +116,21 @@ class DrugPredictor:
                 self.initialization_status["progress"] = 20
                 self.initialization_status["message"] = "Loading model from Hugging Face..."
                 
+                # Always load on CPU: initialization may run in a `gunicorn --preload` master,
+                # and CUDA initialized before fork is unusable in the workers. _ensure_device()
+                # moves inference to the GPU inside each serving process.
+                self.device = "cpu"
+                
                 # FIX: Add trust_remote_code=True to allow custom code execution
                 self.model = SentenceTransformer(
                     self.config.MODEL_NAME,
-                    trust_remote_code=True
+                    trust_remote_code=True,
+                    device=self.device
                 )
+                # An uncased tokenizer lower-cases inputs itself, so case can be folded into the cache key
+                self._lowercase_cache_key = getattr(self.model.tokenizer, 'do_lower_case', False) is True
                 
-                logger.info("Model loaded successfully!")
+                logger.info(f"Model loaded successfully on {self.device}!")
                 self.initialization_status["progress"] = 50
                 self.initialization_status["message"] = "Model loaded successfully"
                 
@@ -116,6 +170,68 @@ class DrugPredictor:
                 self.initialization_status["end_time"] = time.time()
                 return False
     
+    def _compile_model(self):
+        """Compile the transformer forward pass and pad inputs to fixed length buckets"""
+        logger.info(f"Compiling model with torch.compile on {self.device}...")
+        transformer = self.model[0]
+        auto_model = transformer.auto_model
+        tokenize = transformer.tokenize
+        tokenizer = transformer.tokenizer
+        max_length = transformer.max_seq_length
+        
+        def bucketed_tokenize(texts, **kwargs):
+            features = tokenize(texts, **kwargs)
+            length = features['input_ids'].shape[1]
+            bucket = next((b for b in TOKEN_LENGTH_BUCKETS if length <= b <= max_length), length)
+            if bucket == length:
+                return features
+            
+            # Padded positions are masked out, so pooled embeddings are unchanged
+            padding = (bucket - length, 0) if tokenizer.padding_side == 'left' else (0, bucket - length)
+            for key, value in features.items():
+                if isinstance(value, torch.Tensor) and value.dim() == 2 and value.shape[1] == length:
+                    fill = tokenizer.pad_token_id if key == 'input_ids' else 0
+                    features[key] = torch.nn.functional.pad(value, padding, value=fill)
+            return features
+        
+        transformer.auto_model = torch.compile(auto_model, mode="reduce-overhead")
+        transformer.tokenize = bucketed_tokenize
+        
+        # Warm up on the final device and dtype so later requests reuse the compiled graph
+        try:
+            self.model.encode(["warmup " * 60])
+            logger.info("Model compiled successfully!")
+        except Exception as e:
+            logger.warning(f"torch.compile failed, serving uncompiled model: {str(e)}")
+            transformer.auto_model = auto_model
+            transformer.tokenize = tokenize
+    
+    def _ensure_device(self):
+        """Select the inference device on first use in each process, moving to CUDA when available"""
+        if self._device_pid == os.getpid():
+            return
+        
+        with self._device_lock:
+            if self._device_pid == os.getpid():
+                return
+            
+            if torch.cuda.is_available():
+                logger.info("CUDA available, moving model to GPU with FP16...")
+                self.model.to("cuda")
+                self.model.half()
+                if self.index is None:
+                    # Resident FP16 copy so the similarity matmul never leaves the device
+                    self._device_embeddings = torch.from_numpy(np.array(self.drug_embeddings)).to("cuda").half()
+                self.device = "cuda"
+            
+            # Compiled here rather than at load time: the graph is specialized to the device
+            # and dtype, and compiling in a --preload master would start inductor workers before fork
+            if self.config.TORCH_COMPILE:
+                self._compile_model()
+            
+            logger.info(f"Serving predictions on {self.device} (pid {os.getpid()})")
+            self._device_pid = os.getpid()
+    
     def wait_for_initialization(self, timeout=None) -> bool:
         """Wait for initialization to complete"""
         timeout = timeout or self.config.STARTUP_TIMEOUT
@@ -143,19 +259,35 @@ class DrugPredictor:
             if not os.path.exists(self.config.CSV_PATH):
                 raise FileNotFoundError(f"CSV file not found: {self.config.CSV_PATH}")
             
-            self.df_drugs = pd.read_csv(self.config.CSV_PATH)
-            logger.info(f"CSV loaded with shape: {self.df_drugs.shape}")
-            
-            # Validate required columns
+            # Validate required columns from the header before reading any rows
             required_columns = ['Nama', 'DeskripsiObat']
-            missing_columns = [col for col in required_columns if col not in self.df_drugs.columns]
+            available_columns = pd.read_csv(self.config.CSV_PATH, nrows=0).columns.tolist()
+            missing_columns = [col for col in required_columns if col not in available_columns]
             
             if missing_columns:
-                raise ValueError(f"Missing columns: {missing_columns}. Available: {self.df_drugs.columns.tolist()}")
+                raise ValueError(f"Missing columns: {missing_columns}. Available: {available_columns}")
             
-            # Process data
-            self.df_drugs['ObatLengkap'] = self.df_drugs['Nama'].astype(str) + ' - ' + self.df_drugs['DeskripsiObat'].astype(str)
+            # Only read the columns we use, with declared types (no type sniffing)
+            read_options = {
+                'usecols': required_columns,
+                'dtype': {col: 'string[pyarrow]' for col in required_columns}
+            }
+            if self.config.CSV_CHUNK_SIZE > 0:
+                # The pyarrow engine cannot stream, so large files go through the C engine chunk by chunk
+                chunks = pd.read_csv(self.config.CSV_PATH, chunksize=self.config.CSV_CHUNK_SIZE, **read_options)
+                self.df_drugs = pd.concat((self._prepare_drugs(chunk) for chunk in chunks), ignore_index=True)
+            else:
+                self.df_drugs = self._prepare_drugs(pd.read_csv(self.config.CSV_PATH, engine='pyarrow', **read_options))
+            logger.info(f"CSV loaded with shape: {self.df_drugs.shape}")
+            
+            # Per-chunk deduplication cannot see duplicates across chunks
             self.df_drugs = self.df_drugs.drop_duplicates(subset=['ObatLengkap']).reset_index(drop=True)
+            if self.df_drugs.empty:
+                raise ValueError("Drug database is empty")
+            
+            # Plain lists for positional lookup in predict, avoiding per-result .iloc overhead
+            self._names = self.df_drugs['Nama'].tolist()
+            self._descs = self.df_drugs['DeskripsiObat'].tolist()
             
             logger.info(f"Drug database processed successfully! Total drugs: {len(self.df_drugs)}")
             return True
@@ -167,70 +299,277 @@ class DrugPredictor:
             self.initialization_status["error"] = error_msg
             return False
     
+    def _prepare_drugs(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Build the ObatLengkap text column and drop duplicate drugs"""
+        df = df.fillna('')
+        df['ObatLengkap'] = df['Nama'].str.cat(df['DeskripsiObat'], sep=' - ')
+        return df.drop_duplicates(subset=['ObatLengkap'])
+    
+    def _embedding_cache_path(self) -> str:
+        """Cache file for drug embeddings, keyed by model, database version and storage dtype"""
+        # One subdirectory per model/CSV pair, so deployments sharing EMBEDDING_CACHE_DIR
+        # never prune each other's caches; the file name tracks the database version
+        source_key = hashlib.sha1(
+            f"{self.config.MODEL_NAME}|{os.path.abspath(self.config.CSV_PATH)}".encode()
+        ).hexdigest()
+        version_key = hashlib.sha1(
+            f"{os.path.getmtime(self.config.CSV_PATH)}|{len(self.df_drugs)}|float32".encode()
+        ).hexdigest()
+        return os.path.join(self.config.EMBEDDING_CACHE_DIR, f"emb_{source_key}", f"emb_{version_key}.npy")
+    
     def _generate_embeddings(self) -> bool:
-        """Generate embeddings for all drugs"""
+        """Generate embeddings for all drugs, reusing the on-disk cache when valid"""
+        tmp_path = None
         try:
-            drug_texts = self.df_drugs['ObatLengkap'].tolist()
-            self.drug_embeddings = self.model.encode(
-                drug_texts, 
-                show_progress_bar=True,
-                batch_size=32
-            )
+            cache_path = self._embedding_cache_path()
+            if os.path.exists(cache_path):
+                # Memory-mapped: pages are loaded lazily and shared between worker processes
+                self.drug_embeddings = np.load(cache_path, mmap_mode='r')
+                logger.info(f"Embeddings loaded from cache {cache_path}! Shape: {self.drug_embeddings.shape}")
+            else:
+                # encode() already length-sorts texts before batching, so padding per batch stays minimal.
+                # ObatLengkap is deduplicated on load, so every distinct text is encoded exactly once.
+                drug_texts = self.df_drugs['ObatLengkap'].tolist()
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                
+                # Encode chunk by chunk straight into the memory-mapped cache file so peak
+                # memory is bounded by the chunk, not the database. Embeddings are normalized
+                # so similarity at query time is a plain dot product, and stored as FP32 so the
+                # CPU scan runs on the mapping itself (NumPy/BLAS have no FP16 kernel)
+                embeddings = self._allocate_embeddings(
+                    tmp_path, (len(drug_texts), self.model.get_sentence_embedding_dimension())
+                )
+                if not self._encode_on_gpu(drug_texts, embeddings):
+                    for start in range(0, len(drug_texts), EMBEDDING_CHUNK_ROWS):
+                        embeddings[start:start + EMBEDDING_CHUNK_ROWS] = self.model.encode(
+                            drug_texts[start:start + EMBEDDING_CHUNK_ROWS],
+                            show_progress_bar=True,
+                            batch_size=self.config.EMBEDDING_BATCH_SIZE,
+                            normalize_embeddings=True
+                        )
+                
+                logger.info(f"Embeddings generated successfully! Shape: {embeddings.shape}")
+                self.drug_embeddings = self._save_embedding_cache(embeddings, tmp_path, cache_path)
+            
+            if self.config.INDEX_TYPE != "exact":
+                self._build_index()
             
-            logger.info(f"Embeddings generated successfully! Shape: {self.drug_embeddings.shape}")
             return True
             
         except Exception as e:
             error_msg = f"Error generating embeddings: {str(e)}"
             logger.error(error_msg)
+            if tmp_path:
+                self._remove_file(tmp_path)
             self.initialization_status["status"] = "failed"
             self.initialization_status["error"] = error_msg
             return False
     
+    def _encode_on_gpu(self, drug_texts: List[str], embeddings: np.ndarray) -> bool:
+        """Fill the embedding cache file on CUDA in a separate process; False means encode on CPU"""
+        # The NVML-based check does not initialize CUDA in this (possibly pre-fork) process
+        os.environ.setdefault('PYTORCH_NVML_BASED_CUDA_CHECK', '1')
+        if not isinstance(embeddings, np.memmap) or not torch.cuda.is_available():
+            return False
+        
+        texts_path = f"{embeddings.filename}.texts.json"
+        try:
+            with open(texts_path, 'w', encoding='utf-8') as f:
+                json.dump(drug_texts, f)
+            
+            logger.info("CUDA available, encoding drug database on GPU in a separate process...")
+            result = subprocess.run(
+                [sys.executable, '-m', 'models.gpu_encoder', self.config.MODEL_NAME,
+                 texts_path, embeddings.filename, str(self.config.EMBEDDING_BATCH_SIZE)],
+                cwd=PROJECT_ROOT
+            )
+            if result.returncode != 0:
+                logger.warning(f"GPU encoding failed with exit code {result.returncode}, encoding on CPU instead")
+                return False
+            return True
+        except OSError as e:
+            logger.warning(f"Could not run GPU encoder: {str(e)}, encoding on CPU instead")
+            return False
+        finally:
+            self._remove_file(texts_path)
+    
+    def _build_index(self):
+        """Build a FAISS inner-product index over the normalized drug embeddings"""
+        import faiss  # optional dependency, only needed for INDEX_TYPE other than "exact"
+        
+        dim = self.drug_embeddings.shape[1]
+        if self.config.INDEX_TYPE == "flat":
+            index = faiss.IndexFlatIP(dim)
+        elif self.config.INDEX_TYPE == "hnsw":
+            index = faiss.IndexHNSWFlat(dim, self.config.HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efSearch = self.config.HNSW_EF_SEARCH
+        elif self.config.INDEX_TYPE == "sq8":
+            # int8 codes: 4x smaller than FP32, scanned with SIMD integer kernels
+            index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        else:
+            raise ValueError(f"Unknown INDEX_TYPE: {self.config.INDEX_TYPE}. Expected exact, flat, hnsw or sq8")
+        
+        embeddings = np.ascontiguousarray(self.drug_embeddings, dtype=np.float32)
+        if not index.is_trained:
+            # Scalar quantizer learns per-dimension value ranges from the data
+            index.train(embeddings)
+        index.add(embeddings)
+        self.index = index
+        logger.info(f"FAISS {self.config.INDEX_TYPE} index built with {index.ntotal} vectors")
+    
+    def _allocate_embeddings(self, tmp_path: str, shape) -> np.ndarray:
+        """Allocate the FP32 embedding matrix as a .npy memmap, in memory if the cache is unwritable"""
+        try:
+            os.makedirs(os.path.dirname(tmp_path) or '.', exist_ok=True)
+            return np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape)
+        except OSError as e:
+            logger.warning(f"Could not create embedding cache {tmp_path}: {str(e)}")
+            return np.empty(shape, dtype=np.float32)
+    
+    def _save_embedding_cache(self, embeddings: np.ndarray, tmp_path: str, cache_path: str) -> np.ndarray:
+        """Publish a filled embedding memmap as the cache; failures only cost a re-encode next startup"""
+        if not isinstance(embeddings, np.memmap):
+            return embeddings
+        
+        try:
+            embeddings.flush()
+            # Rename so concurrent workers never read a partially written cache
+            os.replace(tmp_path, cache_path)
+            logger.info(f"Embeddings cached to {cache_path}")
+            self._prune_embedding_cache(cache_path)
+            return np.load(cache_path, mmap_mode='r')
+        except OSError as e:
+            logger.warning(f"Could not write embedding cache {cache_path}: {str(e)}")
+            # The mapping stays valid after unlinking, so keep using it without leaving the file behind
+            self._remove_file(tmp_path)
+            return embeddings
+    
+    def _prune_embedding_cache(self, cache_path: str):
+        """Delete cache files from previous versions of the same model/CSV pair"""
+        # Only the pair's own subdirectory is scanned; processes still mapping
+        # an old file keep their pages until they exit
+        for stale_path in glob.glob(os.path.join(os.path.dirname(cache_path), 'emb_*.npy')):
+            if os.path.abspath(stale_path) != os.path.abspath(cache_path):
+                logger.info(f"Removing stale embedding cache {stale_path}")
+                self._remove_file(stale_path)
+    
+    def _remove_file(self, path: str):
+        """Best-effort file removal for cache housekeeping"""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove {path}: {str(e)}")
+    
     def predict(self, keluhan: str, anamnesa: str, top_k: int = 5) -> List[Dict]:
         """Predict drugs based on symptoms and anamnesa"""
         if self.initialization_status["status"] != "completed":
             raise RuntimeError("Model not initialized")
         
-        # Combine and clean query
-        query = f"{keluhan} {anamnesa}".strip()
+        # Combine and clean query (whitespace-collapsed, which tokenizers ignore anyway)
+        query = " ".join(f"{keluhan} {anamnesa}".split())
         if not query:
             raise ValueError("Query cannot be empty")
         
-        # Generate query embedding
-        query_embedding = self.model.encode([query])
+        # Key on exactly what the model sees, so a cache hit never changes the result
+        cache_key = (query.lower() if self._lowercase_cache_key else query, top_k)
+        with self._prediction_cache_lock:
+            cached = self._prediction_cache.get(cache_key)
+        if cached is not None:
+            return [dict(drug_info) for drug_info in cached]
         
-        # Calculate similarities
-        similarities = cosine_similarity(query_embedding, self.drug_embeddings)[0]
+        self._ensure_device()
         
-        # Get top-k results
-        top_indices = np.argsort(similarities)[::-1][:top_k]
-        top_scores = similarities[top_indices]
+        # Generate unit-length query embedding, batched with concurrent requests
+        if self._query_batcher is not None:
+            query_embedding = self._query_batcher.submit(query)
+        else:
+            query_embedding = self._encode_queries([query])[0]
+        
+        # Cosine similarity against pre-normalized drug embeddings
+        top_indices, top_scores = self._search(query_embedding, top_k)
+        
+        # side='right' so a score equal to a threshold falls into the higher bucket
+        confidences = self._CONF_LABELS[np.searchsorted(self._CONF_THRESH, top_scores, side='right')]
         
         # Format results
         results = []
-        for i, (idx, score) in enumerate(zip(top_indices, top_scores)):
+        for i, (idx, score, confidence) in enumerate(zip(top_indices, top_scores, confidences)):
             drug_info = {
                 'rank': i + 1,
-                'nama_obat': self.df_drugs.iloc[idx]['Nama'],
-                'deskripsi_obat': self.df_drugs.iloc[idx]['DeskripsiObat'],
-                'similarity_score': float(score),
-                'confidence': self._get_confidence_level(float(score))
+                'nama_obat': self._names[idx],
+                'deskripsi_obat': self._descs[idx],
+                'similarity_score': score,
+                'confidence': str(confidence)
             }
             results.append(drug_info)
         
+        with self._prediction_cache_lock:
+            self._prediction_cache[cache_key] = tuple(dict(drug_info) for drug_info in results)
+        
         return results
     
-    def _get_confidence_level(self, score: float) -> str:
-        """Convert similarity score to confidence level"""
-        if score >= 0.8:
-            return "high"
-        elif score >= 0.6:
-            return "medium"
-        elif score >= 0.4:
-            return "low"
+    def _encode_queries(self, queries: List[str]) -> Union[np.ndarray, torch.Tensor]:
+        """Encode a batch of queries in a single forward pass"""
+        if self._device_embeddings is not None:
+            return self.model.encode(
+                queries,
+                batch_size=len(queries),
+                normalize_embeddings=True,
+                convert_to_tensor=True
+            ).half()
+        
+        # FAISS and sgemv need float32; a no-op unless the model runs in FP16 on GPU
+        return self.model.encode(
+            queries,
+            batch_size=len(queries),
+            normalize_embeddings=True
+        ).astype(np.float32, copy=False)
+    
+    def _search(self, query_embedding: Union[np.ndarray, torch.Tensor], top_k: int):
+        """Return (indices, scores) of the top_k most similar drugs in descending order"""
+        if self.index is not None:
+            scores, indices = self.index.search(query_embedding.reshape(1, -1), top_k)
+            # FAISS pads with -1 when fewer than top_k results exist
+            found = indices[0] >= 0
+            return indices[0][found], scores[0][found]
+        
+        # Exact scan: partial sort, then order only the k candidates
+        if self._device_embeddings is not None:
+            similarities = (self._device_embeddings @ query_embedding).float().cpu().numpy()
+            top_indices = self._top_k_indices(similarities, top_k)
+            return top_indices, similarities[top_indices]
+        
+        similarities = self._acquire_similarity_buffer()
+        try:
+            # Transpose of the C-ordered (memory-mapped) matrix is Fortran-ordered, so BLAS reads
+            # the mapping in place; trans=1 computes drug_embeddings @ query into the reused buffer
+            similarities = sgemv(1.0, self.drug_embeddings.T, query_embedding, y=similarities, overwrite_y=True, trans=1)
+            top_indices = self._top_k_indices(similarities, top_k)
+            return top_indices, similarities[top_indices]
+        finally:
+            self._similarity_buffers.append(similarities)
+    
+    def _acquire_similarity_buffer(self) -> np.ndarray:
+        """Take a score buffer from the pool, allocating one only when all are in use"""
+        try:
+            buffer = self._similarity_buffers.pop()  # list.pop/append are atomic under the GIL
+            if buffer.shape[0] == len(self.drug_embeddings):
+                return buffer
+        except IndexError:
+            pass
+        return np.empty(len(self.drug_embeddings), dtype=np.float32)
+    
+    def _top_k_indices(self, scores: np.ndarray, top_k: int) -> np.ndarray:
+        """Return indices of the top_k highest scores in descending order"""
+        top_k = min(top_k, len(scores))
+        if top_k < len(scores):
+            # Partition at the k-th largest directly, avoiding a negated copy of the scores
+            candidates = np.argpartition(scores, len(scores) - top_k)[-top_k:]
         else:
-            return "very_low"
+            candidates = np.arange(len(scores))
+        return candidates[np.argsort(scores[candidates])[::-1]]
     
     def is_ready(self) -> bool:
         """Check if model is ready for predictions"""
@@ -265,6 +604,7 @@ class DrugPredictor:
             'total_drugs': len(self.df_drugs),
             'columns': self.df_drugs.columns.tolist(),
             'embedding_shape': self.drug_embeddings.shape if self.drug_embeddings is not None else None,
+            'index_type': self.config.INDEX_TYPE,
             'model_name': self.config.MODEL_NAME,
             'csv_path': self.config.CSV_PATH
         }
\ No newline at end of file
@@ -0,0 +1,42 @@
+import argparse
+import json
+import logging
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from models.drug_predictor import EMBEDDING_CHUNK_ROWS
+
+logger = logging.getLogger(__name__)
+
+# Run by DrugPredictor as `python -m models.gpu_encoder ...` when the embedding cache is
+# missing and a GPU is present. Initialization may happen in a `gunicorn --preload` master,
+# which must never initialize CUDA itself, so the encode runs in a fresh interpreter.
+
+def encode_to_file(model_name: str, texts_path: str, output_path: str, batch_size: int):
+    """Encode texts on CUDA into the preallocated .npy embedding file"""
+    with open(texts_path, encoding='utf-8') as f:
+        texts = json.load(f)
+
+    model = SentenceTransformer(model_name, trust_remote_code=True, device="cuda")
+    embeddings = np.load(output_path, mmap_mode='r+')
+
+    for start in range(0, len(texts), EMBEDDING_CHUNK_ROWS):
+        embeddings[start:start + EMBEDDING_CHUNK_ROWS] = model.encode(
+            texts[start:start + EMBEDDING_CHUNK_ROWS],
+            show_progress_bar=True,
+            batch_size=batch_size,
+            normalize_embeddings=True
+        )
+
+    embeddings.flush()
+    logger.info(f"Encoded {len(texts)} drug texts on GPU into {output_path}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Encode drug texts on GPU into an embedding cache file")
+    parser.add_argument('model_name')
+    parser.add_argument('texts_path')
+    parser.add_argument('output_path')
+    parser.add_argument('batch_size', type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    encode_to_file(args.model_name, args.texts_path, args.output_path, args.batch_size)
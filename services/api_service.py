@@ -1,5 +1,6 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
 from flask_cors import CORS
+import orjson
 import logging
 import threading
 from typing import Dict, Any
@@ -7,6 +8,13 @@ import time
 
 logger = logging.getLogger(__name__)
 
+def ojsonify(payload: Dict[str, Any]) -> Response:
+    """jsonify replacement using orjson, which also serializes NumPy scalars natively"""
+    return Response(
+        orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+        mimetype='application/json'
+    )
+
 class APIService:
     def __init__(self, config, drug_predictor):
         self.config = config
@@ -15,10 +23,13 @@ class APIService:
         self._setup_flask()
         self._register_routes()
         
-        # Auto-initialize if configured
+        # Auto-initialize if configured. Runs synchronously so that with
+        # `gunicorn --preload` the model and embeddings are loaded once in the
+        # master and shared copy-on-write by the forked workers; no background
+        # thread may be alive at fork time.
         if self.config.AUTO_INITIALIZE:
-            logger.info("Auto-initialization enabled, starting model loading...")
-            self.drug_predictor.initialize(background=True)
+            logger.info("Auto-initialization enabled, loading model...")
+            self.drug_predictor.initialize(background=False)
     
     def _setup_flask(self):
         """Configure Flask application"""
@@ -45,7 +56,7 @@ class APIService:
         @self.app.route('/', methods=['GET'])
         def health_check():
             """Health check endpoint"""
-            return jsonify({
+            return ojsonify({
                 'status': 'success',
                 'message': 'Drug Recommendation API is running!',
                 'version': '2.0.0',
@@ -66,13 +77,13 @@ class APIService:
         def readiness_check():
             """Kubernetes-style readiness check"""
             if self.drug_predictor.is_ready():
-                return jsonify({
+                return ojsonify({
                     'status': 'ready',
                     'message': 'API is ready to serve requests'
                 }), 200
             else:
                 status = self.drug_predictor.get_status()
-                return jsonify({
+                return ojsonify({
                     'status': 'not_ready',
                     'message': f'Initialization in progress: {status["message"]}',
                     'progress': status["progress"]
@@ -81,7 +92,7 @@ class APIService:
         @self.app.route('/status', methods=['GET'])
         def get_status():
             """Get initialization status"""
-            return jsonify({
+            return ojsonify({
                 'status': 'success',
                 'data': self.drug_predictor.get_status()
             })
@@ -92,18 +103,18 @@ class APIService:
             try:
                 stats = self.drug_predictor.get_stats()
                 if 'error' in stats:
-                    return jsonify({
+                    return ojsonify({
                         'status': 'error',
                         'message': stats['error']
                     }), 503
                 
-                return jsonify({
+                return ojsonify({
                     'status': 'success',
                     'data': stats
                 })
             except Exception as e:
                 logger.error(f"Error getting stats: {str(e)}")
-                return jsonify({
+                return ojsonify({
                     'status': 'error',
                     'message': f'An error occurred: {str(e)}'
                 }), 500
@@ -114,14 +125,14 @@ class APIService:
             status = self.drug_predictor.get_status()
             
             if status["status"] == "in_progress":
-                return jsonify({
+                return ojsonify({
                     'status': 'info',
                     'message': 'Initialization already in progress',
                     'progress': status["progress"]
                 })
             
             if status["status"] == "completed":
-                return jsonify({
+                return ojsonify({
                     'status': 'success',
                     'message': 'Model already initialized'
                 })
@@ -129,7 +140,7 @@ class APIService:
             # Start initialization
             self.drug_predictor.initialize(background=True)
             
-            return jsonify({
+            return ojsonify({
                 'status': 'success',
                 'message': 'Initialization started',
                 'estimated_time': '2-5 minutes'
@@ -144,21 +155,21 @@ class APIService:
                     status = self.drug_predictor.get_status()
                     
                     if status["status"] == "not_started":
-                        return jsonify({
+                        return ojsonify({
                             'status': 'error',
                             'message': 'Model not initialized. Please wait for auto-initialization or call POST /initialize.',
                             'initialization_status': status
                         }), 503
                     
                     if status["status"] == "in_progress":
-                        return jsonify({
+                        return ojsonify({
                             'status': 'info',
                             'message': f'Model initialization in progress ({status["progress"]}%). Please wait...',
                             'initialization_status': status
                         }), 202
                     
                     if status["status"] == "failed":
-                        return jsonify({
+                        return ojsonify({
                             'status': 'error',
                             'message': 'Model initialization failed',
                             'error': status.get("error")
@@ -167,7 +178,7 @@ class APIService:
                 # Validate request
                 data = request.get_json()
                 if not data:
-                    return jsonify({
+                    return ojsonify({
                         'status': 'error',
                         'message': 'No JSON data provided'
                     }), 400
@@ -178,7 +189,7 @@ class APIService:
                 top_k = data.get('top_k', self.config.DEFAULT_TOP_K)
                 
                 if not keluhan and not anamnesa:
-                    return jsonify({
+                    return ojsonify({
                         'status': 'error',
                         'message': 'Either keluhan or anamnesa must be provided'
                     }), 400
@@ -191,7 +202,7 @@ class APIService:
                 predictions = self.drug_predictor.predict(keluhan, anamnesa, top_k)
                 processing_time = (time.time() - start_time) * 1000  # Convert to milliseconds
                 
-                return jsonify({
+                return ojsonify({
                     'status': 'success',
                     'query': {
                         'keluhan': keluhan,
@@ -204,32 +215,32 @@ class APIService:
                 })
                 
             except ValueError as e:
-                return jsonify({
+                return ojsonify({
                     'status': 'error',
                     'message': str(e)
                 }), 400
             except RuntimeError as e:
-                return jsonify({
+                return ojsonify({
                     'status': 'error',
                     'message': str(e)
                 }), 503
             except Exception as e:
                 logger.error(f"Error in predict endpoint: {str(e)}")
-                return jsonify({
+                return ojsonify({
                     'status': 'error',
                     'message': 'An internal error occurred'
                 }), 500
         
         @self.app.errorhandler(404)
         def not_found(error):
-            return jsonify({
+            return ojsonify({
                 'status': 'error',
                 'message': 'Endpoint not found'
             }), 404
         
         @self.app.errorhandler(500)
         def internal_error(error):
-            return jsonify({
+            return ojsonify({
                 'status': 'error',
                 'message': 'Internal server error'
             }), 500